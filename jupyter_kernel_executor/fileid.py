@@ -1,6 +1,7 @@
 class FileIDWrapper:
     def __init__(self, file_id_manager, save_lock):
         self.file_id_manager = file_id_manager
+        # callable returning an async context manager holding the save lock of a file id
         self.save_lock = save_lock
         if file_id_manager:
             try:
@@ -45,7 +46,7 @@ class FileIDWrapper:
         if not file_id:
             return None
         if self.enable:
-            async with self.save_lock:
+            async with self.save_lock(file_id):
                 row = self.file_id_manager.con.execute("SELECT path, ino FROM Files WHERE id = ?",
                                                        (file_id,)).fetchone()
                 path, ino = row
@@ -56,7 +57,7 @@ class FileIDWrapper:
                 # inode change, let file_id_manger sync it
                 # finally fallback to file_id itself
                 path = self.file_id_manager.get_path(file_id) or file_id
-                self.log.debug(f'convert id {file_id} to file {path}')
+                self.log.debug('convert id %s to file %s', file_id, path)
         else:
             path = file_id
         return path
@@ -69,7 +70,7 @@ class FileIDWrapper:
         if self.file_id_manager:
             # get or index it
             file_id = self.file_id_manager.get_id(path) or self.index(path)
-            self.log.debug(f'tracking file {path} with id {file_id}')
+            self.log.debug('tracking file %s with id %s', path, file_id)
         else:
             file_id = path
         return file_id
@@ -1,11 +1,18 @@
 import asyncio
+import functools
 import json
+import logging
 import os
-from typing import Optional, Dict, List
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Tuple, Any
 
 import tornado.web
 from jupyter_server.base.handlers import APIHandler
+from jupyter_core.paths import is_hidden
+from jupyter_server.services.contents.fileio import FileManagerMixin, AsyncFileManagerMixin
+from jupyter_server.services.contents.filemanager import FileContentsManager, AsyncFileContentsManager
 from jupyter_server.utils import ensure_async
 from watchfiles import awatch, Change
 
@@ -13,25 +20,87 @@ from jupyter_kernel_client.client import KernelWebsocketClient
 from jupyter_kernel_executor.file_watcher import FileWatcher
 from jupyter_kernel_executor.fileid import FileIDWrapper
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_dumps(obj) -> str:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode()
+        except orjson.JSONEncodeError:
+            # e.g. integers out of 64-bit range, which json accepts
+            pass
+    return json.dumps(obj)
+
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 
 class ExecuteCellHandler(APIHandler):
-    executing_cell: Dict[str, List[
-        Dict[str, str]]
+    executing_cell: Dict[str, Dict[
+        Tuple[str, str], Dict[str, Any]]
     ] = dict()
-    save_lock = asyncio.Lock()
+    # save key -> cell_id -> latest result, waiting to be written
+    pending_outputs: Dict[str, Dict[str, Dict]] = dict()
+    # save key -> lock guarding read-modify-write of that document
+    save_locks: Dict[str, asyncio.Lock] = dict()
+    # save key -> number of tasks holding or waiting for its save lock
+    save_lock_users: Dict[str, int] = dict()
+    # bounded, so concurrent reads of many notebooks don't thrash the disk
+    executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='jupyter_kernel_executor')
 
     def initialize(self):
-        self.execution_start_datetime: Optional[datetime] = None
-        self.execution_end_datetime: Optional[datetime] = None
+        self.execution_start: Optional[float] = None
+        # built once per request, used several times per execution
+        self.file_id_manager: FileIDWrapper = FileIDWrapper(self.settings.get("file_id_manager"), self.save_lock)
         self.watch_dir = self.normal_path(self.serverapp.root_dir or '.')
         self.global_watcher = FileWatcher(self.file_id_manager)
 
     def finish(self, *args, **kwargs):
         return super().finish(*args, **kwargs)
 
-    @property
-    def file_id_manager(self) -> FileIDWrapper:
-        return FileIDWrapper(self.settings.get("file_id_manager"), self.save_lock)
+    @classmethod
+    @asynccontextmanager
+    async def save_lock(cls, document_id):
+        # created lazily inside the running loop, one per document
+        lock = cls.save_locks.get(document_id)
+        if lock is None:
+            lock = cls.save_locks[document_id] = asyncio.Lock()
+        cls.save_lock_users[document_id] = cls.save_lock_users.get(document_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            cls.save_lock_users[document_id] -= 1
+            if not cls.save_lock_users[document_id]:
+                # no one holds or waits for it, prevent memory leak
+                del cls.save_lock_users[document_id]
+                del cls.save_locks[document_id]
+
+    def save_key(self, document_id, path):
+        """
+        Key of save lock, the same file must always get the same key.
+        File id is canonical while raw path is not, e.g. test.ipynb and ./test.ipynb
+        """
+        if self.file_id_manager.enable:
+            # same as FileIDWrapper.get_path locks
+            return document_id
+        return os.path.normpath(path)
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """
+        Run blocking function in executor, so event loop keeps processing kernel messages meanwhile.
+
+        Only for thread-safe functions, sync contents manager is not (notary's sqlite is bound to its thread).
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
 
     def normal_path(self, path):
         return self.file_id_manager.normalize_path(path)
@@ -50,20 +119,20 @@ class ExecuteCellHandler(APIHandler):
         if not self.kernel_manager.get_kernel(kernel_id):
             raise tornado.web.HTTPError(404, f"No such kernel {kernel_id}")
 
-        records = self.executing_cell.get(kernel_id, [])
+        records = self.executing_cell.get(kernel_id, {})
         response = [
             {
                 "path": await self.get_path(record['document_id']),
                 "cell_id": record['cell_id'],
-            } for record in records
+            } for record in list(records.values())
         ]
 
-        await self.finish(json.dumps(
+        await self.finish(json_dumps(
             response
         ))
 
     def is_executing(self, kernel_id, document_id, cell_id):
-        return self.get_record(document_id, cell_id) in self.executing_cell.get(kernel_id, [])
+        return (document_id, cell_id) in self.executing_cell.get(kernel_id, {})
 
     @tornado.web.authenticated
     async def post(self, kernel_id):
@@ -91,8 +160,8 @@ class ExecuteCellHandler(APIHandler):
         not_write = model.get('not_write', False)
         document_id = self.index(path)
         if self.is_executing(kernel_id, document_id, cell_id):
-            self.log.info(f'cell {cell_id} of {path}(id:{document_id}) is executing')
-            return await self.finish(json.dumps(
+            self.log.info('cell %s of %s(id:%s) is executing', cell_id, path, document_id)
+            return await self.finish(json_dumps(
                 model
             ))
 
@@ -123,16 +192,27 @@ class ExecuteCellHandler(APIHandler):
         if not block:
             self.log.debug("async execute code, write result to file")
 
+            written = None
+
             async def write_callback():
+                nonlocal written
+                result = client.get_result()
+                # client notifies on every kernel message, while outputs are only appended,
+                # skip writing when nothing new since last write
+                seen = (len(result['outputs']), result['execution_count'])
+                if seen == written:
+                    return
                 try:
-                    await self.write_output(document_id, cell_id, client.get_result())
+                    await self.write_output(document_id, cell_id, result)
+                    # on failure, retry with next kernel message
+                    written = seen
                 except Exception as e:
                     self.log.error('Exception when asynchronous writing result to file')
                     self.log.exception(e)
 
             if not not_write:
                 client.register_callback(write_callback)
-            await self.finish(json.dumps(
+            await self.finish(json_dumps(
                 model
             ))
             await self.execute(client, code, document_id, cell_id)
@@ -141,7 +221,7 @@ class ExecuteCellHandler(APIHandler):
             result = await self.execute(client, code, document_id, cell_id)
             if not not_write:
                 await self.write_output(document_id, cell_id, result)
-            await self.finish(json.dumps({
+            await self.finish(json_dumps({
                 **model,
                 **result
             }))
@@ -153,28 +233,37 @@ class ExecuteCellHandler(APIHandler):
             result = await client.execute(code)
         finally:
             await self.post_execute(kernel_id, document_id, cell_id)
-        self.log.debug(f'execute time: {self.execution_end_datetime - self.execution_start_datetime}')
+        if self.execution_start is not None:
+            self.log.debug('execute time: %.3fs', time.monotonic() - self.execution_start)
         return result
 
     async def pre_execute(self, kernel_id, document_id, cell_id):
         if document_id and cell_id:
-            self.executing_cell.setdefault(kernel_id, []).append(
-                self.get_record(document_id, cell_id)
-            )
+            records = self.executing_cell.setdefault(kernel_id, {})
+            record = records.get((document_id, cell_id))
+            if record is None:
+                record = records[(document_id, cell_id)] = self.get_record(document_id, cell_id)
+            # same cell may be posted again before is_executing sees it, count executions
+            record['count'] = record.get('count', 0) + 1
             self.global_watcher.add(self)
             self.global_watcher.start_if_not(self.watch_dir)
 
-        self.execution_start_datetime = datetime.now()
+        # only timed for the debug log
+        self.execution_start = time.monotonic() if self.log.isEnabledFor(logging.DEBUG) else None
 
     async def post_execute(self, kernel_id, document_id, cell_id):
-        self.execution_end_datetime = datetime.now()
-        records = self.executing_cell.get(kernel_id, [])
+        records = self.executing_cell.get(kernel_id, {})
         if document_id and cell_id:
             # prevent memory leak
             self.global_watcher.remove(self)
-            record = self.get_record(document_id, cell_id)
-            if record in records:
-                records.remove(record)
+            record = records.get((document_id, cell_id))
+            if record is not None:
+                record['count'] -= 1
+                if not record['count']:
+                    records.pop((document_id, cell_id))
+            if not records:
+                # drop idle kernels, shutdown kernels would never be cleaned up otherwise
+                self.executing_cell.pop(kernel_id, None)
 
     def get_record(self, document_id, cell_id):
         return {
@@ -187,6 +276,9 @@ class ExecuteCellHandler(APIHandler):
             return None
         cm = self.contents_manager
         path = await self.get_path(document_id)
+        code = await self.run_blocking(self.read_code_from_file, cm, path, cell_id)
+        if code is not None:
+            return code
         model = await ensure_async(cm.get(path, content=True, type='notebook'))
         nb = model['content']
         for cell in nb['cells']:
@@ -194,33 +286,87 @@ class ExecuteCellHandler(APIHandler):
                 return cell['source']
         raise tornado.web.HTTPError(404, f"cell {cell_id} not found in {path}")
 
+    def read_code_from_file(self, cm, path, cell_id) -> Optional[str]:
+        """
+        Fast path for local file contents managers, find the cell in raw json
+        without nbformat parsing and validating every cell and output of the notebook.
+
+        Return None to fall back to contents manager.
+        """
+        if type(cm).get not in (FileContentsManager.get, AsyncFileContentsManager.get):
+            # contents manager may transform file content, e.g. jupytext
+            return None
+        if type(cm)._read_notebook not in (FileManagerMixin._read_notebook, AsyncFileManagerMixin._read_notebook):
+            # e.g. decrypting notebook when reading
+            return None
+        try:
+            os_path = cm._get_os_path(path)
+            if not os.path.isfile(os_path):
+                return None
+            # let contents manager refuse it as it does with get
+            if not getattr(cm, 'allow_hidden', False) and is_hidden(os_path, cm.root_dir):
+                return None
+            with open(os_path, 'rb') as f:
+                nb = json_loads(f.read())
+            cells = nb['cells']
+        except Exception:
+            return None
+        for cell in cells:
+            if isinstance(cell, dict) and cell.get('id') == cell_id:
+                source = cell.get('source', '')
+                # nbformat stores multiline string as list of lines
+                return source if isinstance(source, str) else ''.join(source)
+        return None
+
     async def write_output(self, document_id, cell_id, result):
         if not document_id or not cell_id:
             return
         cm = self.contents_manager
         path = await self.get_path(document_id)
-        async with self.save_lock:
-            model = await ensure_async(cm.get(path, content=True, type='notebook'))
-            nb = model['content']
-            updated = False
-            for cell in nb['cells']:
-                if cell['id'] == cell_id:
-                    if result['outputs'] != cell["outputs"]:
-                        cell["outputs"] = result['outputs']
+        key = self.save_key(document_id, path)
+        # newer result of the same cell replaces the queued one
+        self.pending_outputs.setdefault(key, {})[cell_id] = result
+        async with self.save_lock(key):
+            # results queued while waiting for the lock are written in one save
+            results = self.pending_outputs.pop(key, None)
+            if not results:
+                # already written by a previous writer
+                return
+            try:
+                model = await ensure_async(cm.get(path, content=True, type='notebook'))
+                nb = model['content']
+                updated = False
+                remaining = len(results)
+                for cell in nb['cells']:
+                    cell_result = results.get(cell['id'])
+                    if cell_result is None:
+                        continue
+                    if cell_result['outputs'] != cell["outputs"]:
+                        cell["outputs"] = cell_result['outputs']
                         updated = True
-                    if result['execution_count']:
-                        cell['execution_count'] = int(result['execution_count'])
+                    if cell_result['execution_count']:
+                        cell['execution_count'] = int(cell_result['execution_count'])
                         updated = True
-                    break
-            if updated:
-                await ensure_async(cm.save(model, path))
-                self.file_id_manager.save(path)
+                    remaining -= 1
+                    if not remaining:
+                        break
+                if updated:
+                    await ensure_async(cm.save(model, path))
+                    self.file_id_manager.save(path)
+            except Exception:
+                if self.save_lock_users[key] > 1:
+                    # requeue for writers waiting for the lock, results queued meanwhile are newer
+                    pending = self.pending_outputs.setdefault(key, {})
+                    for queued_cell_id, cell_result in results.items():
+                        pending.setdefault(queued_cell_id, cell_result)
+                # otherwise drop them, stale results must not overwrite the cell later
+                raise
 
     def executing_document(self):
         executing_document = []
         for kernel_records in self.executing_cell.values():
-            for records in kernel_records:
-                executing_document.append(records['document_id'])
+            for record in kernel_records.values():
+                executing_document.append(record['document_id'])
         return executing_document
 
 
@@ -228,7 +374,7 @@ def setup_handlers(web_app):
     host_pattern = ".*$"
 
     base_url = web_app.settings["base_url"].rstrip('/')
-    _kernel_id_regex = r"(?P<kernel_id>\w+-\w+-\w+-\w+-\w+)"
+    _kernel_id_regex = r"(?P<kernel_id>[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})"
     handlers = [
         (rf"{base_url}/api/kernels/{_kernel_id_regex}/execute", ExecuteCellHandler),
     ]
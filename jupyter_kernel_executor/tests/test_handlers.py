@@ -1,3 +1,5 @@
+import copy
+import json
 import os
 from pathlib import Path
 
@@ -15,7 +17,7 @@ print('world')
 list_code = [line + '\n' for line in str_code.split('\n')]
 
 
-@pytest.fixture(name='ipynb', params=(list_code,))
+@pytest.fixture(name='ipynb', params=(list_code, str_code))
 def _ipynb(request, jp_root_dir):
     code = request.param
     example_ipynb_path = _here / "test.ipynb"
@@ -31,13 +33,22 @@ def _ipynb(request, jp_root_dir):
     nb['cells'][0]['outputs'] = []
 
     with open(filepath, "w") as f:
-        nbformat.write(nb, f)
+        # nbformat.write splits multiline source into list of lines, keep source as is
+        json.dump(nb, f)
 
     yield test_ipynb_path, cell_id, filepath.as_posix()
 
 
 from .utils import *
 
+from jupyter_server.services.contents.filemanager import FileContentsManager
+from jupyter_server.services.contents.largefilemanager import AsyncLargeFileManager
+import tornado.web
+from tornado.httpclient import HTTPClientError
+
+from jupyter_kernel_executor.fileid import FileIDWrapper
+from jupyter_kernel_executor.handlers import ExecuteCellHandler
+
 
 async def test_execute_cell(jp_fetch, ipynb):
     ipynb_path, cell_id, real_path = ipynb
@@ -91,6 +102,61 @@ async def test_execute_cell_abspath(jp_fetch, ipynb):
     await assert_ipynb_cell_outputs(real_path, cell_id, outputs)
 
 
+async def test_execute_cells_concurrently(jp_fetch, ipynb):
+    ipynb_path, cell_id, real_path = ipynb
+    with open(real_path) as f:
+        nb = nbformat.read(f, as_version=nbformat.NO_CONVERT)
+    other_cell_id = nb['cells'][1]['id']
+    nb['cells'][1]['source'] = "print('other')"
+    with open(real_path, "w") as f:
+        nbformat.write(nb, f)
+
+    kernel_ids = []
+    for _ in range(2):
+        kernel_response = await jp_fetch('api', 'kernels', method='POST', body=json.dumps({
+            'name': 'python3',
+            'path': ipynb_path
+        }))
+        kernel_ids.append(json.loads(kernel_response.body)['id'])
+
+    # both cells write to the same notebook at the same time
+    for kernel_id, executed_cell_id in zip(kernel_ids, (cell_id, other_cell_id)):
+        body = {
+            "path": ipynb_path,
+            "cell_id": executed_cell_id,
+        }
+        response = await jp_fetch('api', 'kernels', kernel_id, 'execute', method='POST', body=json.dumps(body))
+        assert response.code == 200
+
+    await wait_for_finished(jp_fetch, kernel_ids[0], ipynb_path, cell_id)
+    await wait_for_finished(jp_fetch, kernel_ids[1], ipynb_path, other_cell_id)
+
+    outputs = [{'name': 'stdout', 'output_type': 'stream', 'text': 'hello\n'},
+               {'name': 'stdout', 'output_type': 'stream', 'text': 'world\n'}]
+    await assert_ipynb_cell_outputs(real_path, cell_id, outputs)
+    other_outputs = [{'name': 'stdout', 'output_type': 'stream', 'text': 'other\n'}]
+    await assert_ipynb_cell_outputs(real_path, other_cell_id, other_outputs)
+
+
+async def test_execute_cell_not_found(jp_fetch, ipynb):
+    ipynb_path, cell_id, real_path = ipynb
+
+    kernel_response = await jp_fetch('api', 'kernels', method='POST', body=json.dumps({
+        'name': 'python3',
+        'path': ipynb_path
+    }))
+    kernel_id = json.loads(kernel_response.body)['id']
+
+    body = {
+        "path": ipynb_path,
+        "cell_id": 'NotExist',
+    }
+
+    with pytest.raises(HTTPClientError) as e:
+        await jp_fetch('api', 'kernels', kernel_id, 'execute', method='POST', body=json.dumps(body))
+    assert e.value.code == 404
+
+
 async def test_execute_code(jp_fetch):
     # will block and execute code, response result of the code
     kernel_response = await jp_fetch('api', 'kernels', method='POST', body=json.dumps({
@@ -112,5 +178,224 @@ async def test_execute_code(jp_fetch):
                        'execution_count': 1}
 
 
+async def test_execute_code_with_big_integer(jp_fetch):
+    kernel_response = await jp_fetch('api', 'kernels', method='POST', body=json.dumps({
+        'name': 'python3',
+        'path': 'NotExist.ipynb'
+    }))
+    kernel_id = json.loads(kernel_response.body)['id']
+
+    # out of 64-bit range, not encodable by orjson
+    body = {
+        "code": "1",
+        "n": 2 ** 64,
+    }
+
+    response = await jp_fetch('api', 'kernels', kernel_id, 'execute', method='POST', body=json.dumps(body))
+
+    assert response.code == 200
+    payload = json.loads(response.body)
+    assert payload['n'] == 2 ** 64
+
+
+class StubContentsManager:
+    def __init__(self, nb):
+        self.nb = nb
+        self.fail_get = False
+
+    async def get(self, path, content=True, type=None):
+        await asyncio.sleep(0)
+        if self.fail_get:
+            self.fail_get = False
+            raise RuntimeError('get failed')
+        return {'content': copy.deepcopy(self.nb)}
+
+    async def save(self, model, path):
+        await asyncio.sleep(0)
+        self.nb = model['content']
+
+
+class StubWatcher:
+    def add(self, handle):
+        pass
+
+    def remove(self, handle):
+        pass
+
+    def start_if_not(self, root_dir):
+        pass
+
+
+class StubHandler(ExecuteCellHandler):
+    executing_cell = {}
+    pending_outputs = {}
+    save_locks = {}
+    save_lock_users = {}
+
+    def __init__(self, contents_manager):
+        self._contents_manager = contents_manager
+        self.file_id_manager = FileIDWrapper(None, self.save_lock)
+        self.global_watcher = StubWatcher()
+        self.watch_dir = '.'
+
+    @property
+    def contents_manager(self):
+        return self._contents_manager
+
+
+async def test_execute_same_cell_twice():
+    handler = StubHandler(None)
+
+    # second post of the same cell started before the first one registered
+    await handler.pre_execute('kernel', 'test.ipynb', 'a')
+    await handler.pre_execute('kernel', 'test.ipynb', 'a')
+    await handler.post_execute('kernel', 'test.ipynb', 'a')
+    assert handler.is_executing('kernel', 'test.ipynb', 'a')
+
+    await handler.post_execute('kernel', 'test.ipynb', 'a')
+    assert not handler.is_executing('kernel', 'test.ipynb', 'a')
+    assert not handler.executing_cell
+
+
+async def test_write_output_requeue_when_save_failed():
+    nb = nbformat.v4.new_notebook(cells=[
+        nbformat.v4.new_code_cell(id='a'),
+        nbformat.v4.new_code_cell(id='b'),
+    ])
+    cm = StubContentsManager(nb)
+    handler = StubHandler(cm)
+    output_a = [{'output_type': 'stream', 'name': 'stdout', 'text': 'a\n'}]
+    output_b = [{'output_type': 'stream', 'name': 'stdout', 'text': 'b\n'}]
+
+    saved = asyncio.Event()
+
+    async def another_writer():
+        async with handler.save_lock('test.ipynb'):
+            await saved.wait()
+
+    # another writer is saving, both writers queue behind it
+    holder = asyncio.create_task(another_writer())
+    await asyncio.sleep(0)
+    writer_b = asyncio.create_task(
+        handler.write_output('test.ipynb', 'b', {'outputs': output_b, 'execution_count': 1})
+    )
+    writer_a = asyncio.create_task(
+        handler.write_output('test.ipynb', 'a', {'outputs': output_a, 'execution_count': 2})
+    )
+    await asyncio.sleep(0.1)
+    # writer_b drains both results, then fails
+    cm.fail_get = True
+    saved.set()
+    await holder
+
+    with pytest.raises(RuntimeError):
+        await writer_b
+    await writer_a
+
+    cells = {cell['id']: cell for cell in cm.nb['cells']}
+    assert cells['a']['outputs'] == output_a
+    assert cells['a']['execution_count'] == 2
+    assert cells['b']['outputs'] == output_b
+    assert not handler.pending_outputs
+    assert not handler.save_locks
+
+
+async def test_write_output_drop_when_save_failed():
+    nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell(id='a')])
+    cm = StubContentsManager(nb)
+    handler = StubHandler(cm)
+    output_a = [{'output_type': 'stream', 'name': 'stdout', 'text': 'a\n'}]
+
+    # no other writer waiting, failed result must not be kept
+    cm.fail_get = True
+    with pytest.raises(RuntimeError):
+        await handler.write_output('test.ipynb', 'a', {'outputs': output_a, 'execution_count': 1})
+
+    assert not handler.pending_outputs
+    assert not handler.save_locks
+    assert cm.nb['cells'][0]['outputs'] == []
+
+
+async def test_write_output_same_file_different_path():
+    nb = nbformat.v4.new_notebook(cells=[
+        nbformat.v4.new_code_cell(id='a'),
+        nbformat.v4.new_code_cell(id='b'),
+    ])
+    cm = StubContentsManager(nb)
+    handler = StubHandler(cm)
+    output_a = [{'output_type': 'stream', 'name': 'stdout', 'text': 'a\n'}]
+    output_b = [{'output_type': 'stream', 'name': 'stdout', 'text': 'b\n'}]
+
+    # without file id, document id is the raw path, different spellings of the same file
+    await asyncio.gather(
+        handler.write_output('test.ipynb', 'a', {'outputs': output_a, 'execution_count': 1}),
+        handler.write_output('./test.ipynb', 'b', {'outputs': output_b, 'execution_count': 2}),
+    )
+
+    cells = {cell['id']: cell for cell in cm.nb['cells']}
+    assert cells['a']['outputs'] == output_a
+    assert cells['b']['outputs'] == output_b
+    assert not handler.pending_outputs
+    assert not handler.save_locks
+
+
+class TransformContentsManager(AsyncLargeFileManager):
+    async def get(self, path, content=True, type=None, format=None, **kwargs):
+        model = await super().get(path, content=content, type=type, format=format, **kwargs)
+        for cell in model['content']['cells']:
+            cell['source'] = 'transformed'
+        return model
+
+
+async def test_read_code_from_overridden_contents_manager(ipynb, jp_root_dir):
+    ipynb_path, cell_id, real_path = ipynb
+    handler = StubHandler(TransformContentsManager(root_dir=str(jp_root_dir)))
+
+    # contents manager overrides get, not to read file directly
+    assert await handler.read_code_from_ipynb(ipynb_path, cell_id) == 'transformed'
+
+
+async def test_read_code_from_file(ipynb, jp_root_dir):
+    ipynb_path, cell_id, real_path = ipynb
+    cm = AsyncLargeFileManager(root_dir=str(jp_root_dir))
+    handler = StubHandler(cm)
+    model = await cm.get(ipynb_path, content=True, type='notebook')
+    source = [cell['source'] for cell in model['content']['cells'] if cell['id'] == cell_id][0]
+
+    # same source as contents manager, for both list and str source in file
+    assert handler.read_code_from_file(cm, ipynb_path, cell_id) == source
+    assert handler.read_code_from_file(cm, ipynb_path, 'NotExist') is None
+
+
+class ReadNotebookContentsManager(AsyncLargeFileManager):
+    async def _read_notebook(self, *args, **kwargs):
+        nb = await super()._read_notebook(*args, **kwargs)
+        for cell in nb['cells']:
+            cell['source'] = 'transformed'
+        return nb
+
+
+async def test_read_code_from_overridden_read_notebook(ipynb, jp_root_dir):
+    ipynb_path, cell_id, real_path = ipynb
+    handler = StubHandler(ReadNotebookContentsManager(root_dir=str(jp_root_dir)))
+
+    assert await handler.read_code_from_ipynb(ipynb_path, cell_id) == 'transformed'
+
+
+async def test_read_code_from_hidden_file(ipynb, jp_root_dir):
+    ipynb_path, cell_id, real_path = ipynb
+    hidden_path = Path(jp_root_dir) / '.hidden' / 'test.ipynb'
+    hidden_path.parent.mkdir()
+    Path(real_path).rename(hidden_path)
+    cm = FileContentsManager(root_dir=str(jp_root_dir))
+    handler = StubHandler(cm)
+
+    # refused by contents manager, not to read file directly
+    assert handler.read_code_from_file(cm, '.hidden/test.ipynb', cell_id) is None
+    with pytest.raises(tornado.web.HTTPError) as e:
+        await handler.read_code_from_ipynb('.hidden/test.ipynb', cell_id)
+    assert e.value.status_code == 404
+
+
 if __name__ == '__main__':
     pytest.main()